@@ -1,18 +1,41 @@
 # context_loader.py
 
-import sqlite3
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Tuple
 import logging
 
-DB_PATH = "firefly_local.db"
+from db import get_ro_conn
+
+def data_version() -> Tuple:
+    """
+    Return a cheap fingerprint of the synced data. It changes whenever
+    firefly_sync inserts or updates accounts, categories, bills or tags, so it
+    can key caches of anything derived from those tables. transactions is left
+    out on purpose: nothing cached reads it, and it is the largest table.
+    """
+    conn = get_ro_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            (SELECT COUNT(*) || '@' || IFNULL(MAX(last_updated), '') FROM accounts),
+            (SELECT COUNT(*) || '@' || IFNULL(MAX(last_updated), '') FROM categories),
+            (SELECT COUNT(*) || '@' || IFNULL(MAX(last_updated), '') FROM bills),
+            (SELECT COUNT(*) FROM transactions_tags)
+    """)
+    return cur.fetchone()
 
 def load_accounts() -> Dict[str, str]:
     """
     Load accounts from the local Firefly DB and return a dict mapping
     account ID (as a string) -> account name.
     For example: {"12": "wallet cash", "15": "cash account", "20": "savings"}.
+    The result is cached until the synced data changes; treat it as read-only.
     """
-    conn = sqlite3.connect(DB_PATH)
+    return _load_accounts(data_version())
+
+@lru_cache(maxsize=1)
+def _load_accounts(version: Tuple) -> Dict[str, str]:
+    conn = get_ro_conn()
     cur = conn.cursor()
 
     # Load asset accounts only
@@ -23,7 +46,6 @@ def load_accounts() -> Dict[str, str]:
         ORDER BY name
     """)
     rows = cur.fetchall()
-    conn.close()
 
     # Build the mapping
     account_map = {}
@@ -40,11 +62,10 @@ def load_categories() -> List[str]:
     Return a simple list of all category names from the local DB, if you want
     them for context as well.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_ro_conn()
     cur = conn.cursor()
     cur.execute("SELECT name FROM categories ORDER BY name")
     rows = cur.fetchall()
-    conn.close()
 
     categories = [r[0] for r in rows if r[0]]
     return categories
@@ -53,18 +74,24 @@ def load_tags() -> List[str]:
     """
     Return a simple list of all unique tags from the transactions_tags table.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_ro_conn()
     cur = conn.cursor()
     cur.execute("SELECT DISTINCT name FROM transactions_tags ORDER BY name")
     rows = cur.fetchall()
-    conn.close()
 
     tags = [r[0] for r in rows if r[0]]
     return tags
 
 def load_bills() -> Dict[int, Dict]:
-    """Return a dict mapping bill ID to bill details."""
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Return a dict mapping bill ID to bill details.
+    The result is cached until the synced data changes; treat it as read-only.
+    """
+    return _load_bills(data_version())
+
+@lru_cache(maxsize=1)
+def _load_bills(version: Tuple) -> Dict[int, Dict]:
+    conn = get_ro_conn()
     cur = conn.cursor()
     cur.execute("""
         SELECT id, name
@@ -72,7 +99,6 @@ def load_bills() -> Dict[int, Dict]:
         ORDER BY name
     """)
     rows = cur.fetchall()
-    conn.close()
 
     bills_map = {}
     for (bill_id, name) in rows:
@@ -86,47 +112,35 @@ def load_bills() -> Dict[int, Dict]:
 def build_prompt_context() -> str:
     """
     Construct a text snippet containing known accounts, categories, tags, and bills
-    that you can embed in your LLM prompt.
+    that you can embed in your LLM prompt. The snippet only changes after a
+    sync, so it is rebuilt only when data_version() moves.
     """
-    account_map = load_accounts()
+    return _build_prompt_context(data_version())
+
+@lru_cache(maxsize=1)
+def _build_prompt_context(version: Tuple) -> str:
+    account_map = _load_accounts(version)
     categories = load_categories()
     tags = load_tags()
-    bills = load_bills()
-
-    # Accounts section
-    accounts_section = "## KNOWN ACCOUNTS:\n"
-    if account_map:
-        for acc_id, name in account_map.items():
-            accounts_section += f'  - "{name}" → {acc_id}\n'
-    else:
-        accounts_section += "  (No accounts found.)\n"
-
-    # Categories section
-    categories_section = "## KNOWN CATEGORIES:\n"
-    if categories:
-        for cat in categories:
-            categories_section += f"  - {cat}\n"
-    else:
-        categories_section += "  (No categories found.)\n"
-
-    # Tags section
-    tags_section = "## KNOWN TAGS:\n"
-    if tags:
-        for tag in tags:
-            tags_section += f"  - {tag}\n"
-    else:
-        tags_section += "  (No tags found.)\n"
-
-    # Bills section
-    bills_section = "## KNOWN BILLS:\n"
-    if bills:
-        for bill_id, details in bills.items():
-            bills_section += f'  - "{details["name"]}" → {bill_id}\n'
-    else:
-        bills_section += "  (No bills found.)\n"
-
-    # Return the combined text
-    return f"{accounts_section}\n{categories_section}\n{tags_section}\n{bills_section}"
+    bills = _load_bills(version)
+
+    sections = [
+        _format_section("KNOWN ACCOUNTS", (f'  - "{name}" → {acc_id}' for acc_id, name in account_map.items()),
+                        "No accounts found."),
+        _format_section("KNOWN CATEGORIES", (f"  - {cat}" for cat in categories), "No categories found."),
+        _format_section("KNOWN TAGS", (f"  - {tag}" for tag in tags), "No tags found."),
+        _format_section("KNOWN BILLS", (f'  - "{details["name"]}" → {bill_id}' for bill_id, details in bills.items()),
+                        "No bills found."),
+    ]
+    return "\n".join(sections)
+
+def _format_section(title: str, lines, empty_note: str) -> str:
+    """Render one '## TITLE:' block, one item per line, built with a single join."""
+    parts = [f"## {title}:"]
+    parts.extend(lines)
+    if len(parts) == 1:
+        parts.append(f"  ({empty_note})")
+    return "\n".join(parts) + "\n"
 
 if __name__ == "__main__":
     # Quick test
@@ -0,0 +1,60 @@
+# db.py
+
+import atexit
+import sqlite3
+import threading
+
+DB_PATH = "firefly_local.db"
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+_pool = []
+_pool_lock = threading.Lock()
+
+def connect(readonly=False) -> sqlite3.Connection:
+    """
+    Open DB_PATH with WAL journaling and relaxed fsync pragmas applied.
+    Write connections run in autocommit mode so callers control transactions
+    explicitly with BEGIN IMMEDIATE. Read-only connections skip the
+    journal_mode switch, which needs write access.
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=memory")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def _pooled(attr: str, readonly: bool) -> sqlite3.Connection:
+    conn = getattr(_local, attr, None)
+    if conn is None:
+        conn = connect(readonly=readonly)
+        setattr(_local, attr, conn)
+        with _pool_lock:
+            _pool.append(conn)
+    return conn
+
+def get_ro_conn() -> sqlite3.Connection:
+    """
+    Return this thread's shared read-only connection. Callers must not close
+    it; keeping it open preserves SQLite's page cache between calls.
+    """
+    return _pooled("ro", readonly=True)
+
+def get_rw_conn() -> sqlite3.Connection:
+    """Return this thread's shared read-write (autocommit) connection."""
+    return _pooled("rw", readonly=False)
+
+@atexit.register
+def close_all():
+    """Close every pooled connection. Registered to run at interpreter exit."""
+    with _pool_lock:
+        while _pool:
+            _pool.pop().close()
@@ -0,0 +1,62 @@
+# embeddings.py
+
+import os
+import struct
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384  # output size of MODEL_NAME
+
+_SCALE = struct.Struct("<f")
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    Return the process-wide SentenceTransformer, loading it on first use.
+    torch and the model weights are imported lazily so modules that only need
+    the database or the prompt context don't pay for them. The lock makes
+    concurrent first callers (e.g. warmup and a request) share one load.
+    """
+    with _model_lock:
+        return _load_model()
+
+@lru_cache(maxsize=1)
+def _load_model():
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(os.cpu_count() or 1)
+    return SentenceTransformer(MODEL_NAME, device="cpu")
+
+def embedding_to_blob(vector) -> bytes:
+    """
+    Quantize an embedding to int8 with a per-vector scale and pack it for the
+    transaction_embeddings table: DIM int8 values followed by a little-endian
+    float32 scale (value = int8 / scale).
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    peak = float(np.max(np.abs(vector)))
+    scale = 127.0 / peak if peak else 1.0
+    quantized = np.round(vector * scale).astype(np.int8)
+    return quantized.tobytes() + _SCALE.pack(scale)
+
+def blob_to_embedding(blob: bytes, out=None) -> np.ndarray:
+    """
+    Unpack a stored embedding into a float32 vector, writing into `out` (a
+    preallocated float32 row) when given. Rows written before quantization
+    (raw float32, 4 * DIM bytes) are still understood.
+    """
+    if out is None:
+        out = np.empty(EMBEDDING_DIM, dtype=np.float32)
+    if len(blob) == 4 * EMBEDDING_DIM:
+        out[:] = np.frombuffer(blob, dtype=np.float32)
+        return out
+    if len(blob) != EMBEDDING_DIM + _SCALE.size:
+        raise ValueError(f"unexpected embedding size: {len(blob)} bytes")
+    (scale,) = _SCALE.unpack_from(blob, EMBEDDING_DIM)
+    quantized = np.frombuffer(blob, dtype=np.int8, count=EMBEDDING_DIM)
+    np.multiply(quantized, np.float32(1.0 / scale), out=out)
+    return out
@@ -1,6 +1,7 @@
-import subprocess
-import json
 import datetime
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import os
 
@@ -9,18 +10,23 @@ load_dotenv()
 FIREFLY_API_TOKEN = os.getenv("FIREFLY_API_TOKEN")
 FIREFLY_API_URL = os.getenv("FIREFLY_API_URL")
 
+# One pooled session keeps the HTTPS connection alive between calls
+_SESSION = requests.Session()
+_SESSION.headers.update({"Authorization": f"Bearer {FIREFLY_API_TOKEN}", "Accept": "application/json"})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def call_firefly_api_curl(endpoint, method="GET", data=None):
-    """Make an API call to Firefly III using curl."""
+    """Make an API call to Firefly III over the pooled HTTP session."""
     url = f"{FIREFLY_API_URL.rstrip('/')}/{endpoint.lstrip('/')}"
-    token = FIREFLY_API_TOKEN
-    curl_cmd = ["curl", "-X", method, url, "-H", f"Authorization: Bearer {token}", "-H", "Accept: application/json"]
-    if method == "POST" and data:
-        curl_cmd += ["-H", "Content-Type: application/json", "-d", json.dumps(data)]
-    result = subprocess.run(curl_cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"Error: {result.stderr}")
+    body = orjson.dumps(data) if method == "POST" and data else None
+    headers = {"Content-Type": "application/json"} if body else None
+    try:
+        response = _SESSION.request(method, url, data=body, headers=headers, timeout=30)
+    except requests.RequestException as e:
+        print(f"Error: {e}")
         return None
-    return json.loads(result.stdout) if result.stdout else None
+    return orjson.loads(response.content) if response.content else None
 
 def process(proposal):
     """Generate and send the final transaction payload to Firefly III."""
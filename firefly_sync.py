@@ -1,303 +1,325 @@
 #!/usr/bin/env python3
 
 import os
-import json
-import sqlite3
-import subprocess
+import orjson
+import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging
-from sentence_transformers import SentenceTransformer
+
+from db import DB_PATH, connect
+from embeddings import MODEL_NAME, embedding_to_blob, get_model
 
 load_dotenv()
 
 FIREFLY_API_TOKEN = os.getenv("FIREFLY_API_TOKEN")
 FIREFLY_API_URL = os.getenv("FIREFLY_API_URL")
-DB_PATH = "firefly_local.db"
+PAGE_FETCH_WORKERS = 8
 
 logging.basicConfig(filename="firefly_sync.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Bump SCHEMA_VERSION whenever _SCHEMA_SQL changes; init_db skips the DDL when
+# the database's PRAGMA user_version is already current.
+SCHEMA_VERSION = 1
+
+_SCHEMA_SQL = f"""
+BEGIN IMMEDIATE;
+
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    currency TEXT,
+    last_updated TEXT
+);
+
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    last_updated TEXT
+);
+
+CREATE TABLE IF NOT EXISTS bills (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    amount_min REAL,
+    amount_max REAL,
+    last_updated TEXT
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    description TEXT,
+    amount REAL,
+    created_at TEXT,  -- Renamed from date to match API
+    source_id INTEGER,
+    destination_id INTEGER,
+    category_id INTEGER,
+    type TEXT,
+    source_name TEXT,
+    destination_name TEXT,
+    category_name TEXT,
+    last_updated TEXT
+);
+
+CREATE TABLE IF NOT EXISTS transactions_tags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id INTEGER,
+    name TEXT,
+    FOREIGN KEY (transaction_id) REFERENCES transactions(id)
+);
+
+CREATE TABLE IF NOT EXISTS transaction_embeddings (
+    transaction_id INTEGER PRIMARY KEY,
+    embedding BLOB,
+    FOREIGN KEY (transaction_id) REFERENCES transactions(id)
+);
+
+-- Tag lookups by transaction and the asset-only account filter.
+-- transaction_embeddings needs no extra index: transaction_id is its primary key.
+CREATE INDEX IF NOT EXISTS idx_tags_tid ON transactions_tags(transaction_id);
+CREATE INDEX IF NOT EXISTS idx_accounts_type ON accounts(type);
+
+PRAGMA user_version = {SCHEMA_VERSION};
+COMMIT;
+"""
+
+# Insert statements are shared module constants so every call reuses the
+# connection's compiled-statement cache entry for them
+_SQL_INSERT_ACCOUNT = """
+    INSERT OR REPLACE INTO accounts (id, name, type, currency, last_updated)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_INSERT_CATEGORY = """
+    INSERT OR REPLACE INTO categories (id, name, last_updated)
+    VALUES (?, ?, ?)
+"""
+_SQL_INSERT_BILL = """
+    INSERT OR REPLACE INTO bills (id, name, amount_min, amount_max, last_updated)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_INSERT_TRANSACTION = """
+    INSERT OR REPLACE INTO transactions (
+        id, description, amount, created_at, source_id, destination_id, category_id, type,
+        source_name, destination_name, category_name, last_updated
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_INSERT_TAG = "INSERT INTO transactions_tags (transaction_id, name) VALUES (?, ?)"
+_SQL_INSERT_EMBEDDING = "INSERT OR REPLACE INTO transaction_embeddings (transaction_id, embedding) VALUES (?, ?)"
+
+# One pooled session keeps the HTTPS connection alive across paginated calls
+_SESSION = requests.Session()
+_SESSION.headers.update({"Authorization": f"Bearer {FIREFLY_API_TOKEN}", "Accept": "application/json"})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def call_firefly_api_curl(endpoint, method="GET", data=None):
     url = f"{FIREFLY_API_URL.rstrip('/')}/{endpoint.lstrip('/')}"
-    token = FIREFLY_API_TOKEN
-    curl_cmd = ["curl", "-X", method, url, "-H", f"Authorization: Bearer {token}", "-H", "Accept: application/json"]
-    if method == "POST" and data:
-        payload = json.dumps(data)
-        curl_cmd += ["-H", "Content-Type: application/json", "-d", payload]
-        logging.debug(f"POST Payload: {payload}")  # Log the payload
-
-    logging.debug(f"Executing API call: {' '.join(curl_cmd)}")
-    logging.debug(f"CURL Command: {curl_cmd}")
-    
-    result = subprocess.run(curl_cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        logging.error(f"API call failed with error: {result.stderr}")
+    body = orjson.dumps(data) if method == "POST" and data else None
+    headers = {"Content-Type": "application/json"} if body else None
+    if body:
+        logging.debug(f"POST Payload: {body.decode()}")  # Log the payload
+
+    logging.debug(f"Executing API call: {method} {url}")
+
+    try:
+        response = _SESSION.request(method, url, data=body, headers=headers, timeout=30)
+    except requests.RequestException as e:
+        logging.error(f"API call failed with error: {e}")
         return None
 
-    logging.debug(f"API Response: {result.stdout}")  # Log the response
+    logging.debug(f"API Response: {response.text}")  # Log the response
+    if not response.content:
+        return None
     try:
-        return json.loads(result.stdout)
-    except json.JSONDecodeError:
-        logging.error(f"Failed to parse API response: {result.stdout}")
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        logging.error(f"Failed to parse API response: {response.text}")
         return None
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+def fetch_all_pages(endpoint, last_sync_time=None):
+    """
+    Fetch every page of a paginated Firefly list endpoint and return the combined
+    "data" items in page order, or None if the first page could not be fetched.
+    Page 1 is fetched first to learn meta.pagination.total_pages; the remaining
+    pages are then fetched concurrently.
+    """
+    def page_endpoint(page):
+        separator = "&" if "?" in endpoint else "?"
+        page_ep = f"{endpoint}{separator}page={page}"
+        if last_sync_time:
+            page_ep += f"&updated_at={last_sync_time}"
+        return page_ep
 
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS accounts (
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        type TEXT,
-        currency TEXT,
-        last_updated TEXT
-    )
-    ''')
-
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS categories (
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        last_updated TEXT
-    )
-    ''')
-
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS bills (
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        amount_min REAL,
-        amount_max REAL,
-        last_updated TEXT
-    )
-    ''')
-
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY,
-        description TEXT,
-        amount REAL,
-        created_at TEXT,  -- Renamed from date to match API
-        source_id INTEGER,
-        destination_id INTEGER,
-        category_id INTEGER,
-        type TEXT,
-        source_name TEXT,
-        destination_name TEXT,
-        category_name TEXT,
-        last_updated TEXT
-    )
-    ''')
-
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS transactions_tags (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        transaction_id INTEGER,
-        name TEXT,
-        FOREIGN KEY (transaction_id) REFERENCES transactions(id)
-    )
-    ''')
-
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS transaction_embeddings (
-        transaction_id INTEGER PRIMARY KEY,
-        embedding BLOB,
-        FOREIGN KEY (transaction_id) REFERENCES transactions(id)
-    )
-    ''')
+    first = call_firefly_api_curl(page_endpoint(1))
+    if not first or "data" not in first:
+        return None
 
-    conn.commit()
+    total_pages = int(first.get("meta", {}).get("pagination", {}).get("total_pages", 1))
+    pages = {1: first["data"]}
+    if total_pages > 1:
+        logging.info(f"Fetching {total_pages - 1} more pages of {endpoint} concurrently")
+        with ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS) as pool:
+            futures = {pool.submit(call_firefly_api_curl, page_endpoint(page)): page
+                       for page in range(2, total_pages + 1)}
+            for future in as_completed(futures):
+                page = futures[future]
+                data = future.result()
+                if not data or "data" not in data:
+                    logging.error(f"No valid data returned for {endpoint} page {page}.")
+                    continue
+                pages[page] = data["data"]
+
+    return [item for page in sorted(pages) for item in pages[page]]
+
+def init_db():
+    conn = connect()
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version < SCHEMA_VERSION:
+        logging.info(f"Upgrading database schema from version {version} to {SCHEMA_VERSION}")
+        conn.executescript(_SCHEMA_SQL)
+    conn.close()
+
+def analyze_db():
+    """Refresh the query planner's statistics after a sync."""
+    conn = connect()
+    conn.execute("ANALYZE")
     conn.close()
 
 # Sync accounts (unchanged)
 def sync_accounts(last_sync_time=None):
     logging.info("Fetching accounts from Firefly...")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    page = 1
-    total_changes = 0
-    
-    while True:
-        endpoint = f"/accounts?type=asset,expense,revenue&page={page}"
-        if last_sync_time:
-            endpoint += f"&updated_at={last_sync_time}"
-        data = call_firefly_api_curl(endpoint)
-        if not data or "data" not in data:
-            logging.error("No valid account data returned.")
-            break
-
-        page_data = data["data"]
-        if not page_data:
-            logging.info(f"No more accounts to fetch at page {page}.")
-            break
-
-        for item in page_data:
-            acc_id = int(item["id"])
-            attrs = item["attributes"]
-            name = attrs.get("name", "")
-            acc_type = attrs.get("type", "")
-            currency = attrs.get("currency_code", "")
-            last_updated = attrs.get("updated_at", "")
-
-            if acc_type in ["reconciliation", "initial-balance"]:
-                continue
-
-            result = cur.execute('''
-                INSERT OR REPLACE INTO accounts (id, name, type, currency, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (acc_id, name, acc_type, currency, last_updated))
-            total_changes += result.rowcount
-
-        conn.commit()
-        page += 1
+    items = fetch_all_pages("/accounts?type=asset,expense,revenue", last_sync_time)
+    if items is None:
+        logging.error("No valid account data returned.")
+        return
 
+    conn = connect()
+    cur = conn.cursor()
+    rows = []
+    for item in items:
+        acc_id = int(item["id"])
+        attrs = item["attributes"]
+        name = attrs.get("name", "")
+        acc_type = attrs.get("type", "")
+        currency = attrs.get("currency_code", "")
+        last_updated = attrs.get("updated_at", "")
+
+        if acc_type in ["reconciliation", "initial-balance"]:
+            continue
+
+        rows.append((acc_id, name, acc_type, currency, last_updated))
+
+    cur.execute("BEGIN IMMEDIATE")
+    cur.executemany(_SQL_INSERT_ACCOUNT, rows)
+    total_changes = cur.rowcount
+    conn.commit()
     conn.close()
     logging.info(f"Accounts synced. Total inserted/updated: {total_changes}")
 
 # Sync categories (unchanged)
 def sync_categories(last_sync_time=None):
     logging.info("Fetching categories...")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    page = 1
-    total_changes = 0
-    
-    while True:
-        endpoint = f"/categories?page={page}"
-        if last_sync_time:
-            endpoint += f"&updated_at={last_sync_time}"
-        data = call_firefly_api_curl(endpoint)
-        if not data or "data" not in data:
-            logging.error("No valid category data returned.")
-            break
-
-        page_data = data["data"]
-        if not page_data:
-            logging.info(f"No more categories to fetch at page {page}.")
-            break
-
-        for item in page_data:
-            cat_id = int(item["id"])
-            attrs = item["attributes"]
-            name = attrs.get("name", "")
-            last_updated = attrs.get("updated_at", "")
-
-            result = cur.execute('''
-                INSERT OR REPLACE INTO categories (id, name, last_updated)
-                VALUES (?, ?, ?)
-            ''', (cat_id, name, last_updated))
-            total_changes += result.rowcount
-
-        conn.commit()
-        page += 1
+    items = fetch_all_pages("/categories", last_sync_time)
+    if items is None:
+        logging.error("No valid category data returned.")
+        return
 
+    conn = connect()
+    cur = conn.cursor()
+    rows = []
+    for item in items:
+        cat_id = int(item["id"])
+        attrs = item["attributes"]
+        name = attrs.get("name", "")
+        last_updated = attrs.get("updated_at", "")
+
+        rows.append((cat_id, name, last_updated))
+
+    cur.execute("BEGIN IMMEDIATE")
+    cur.executemany(_SQL_INSERT_CATEGORY, rows)
+    total_changes = cur.rowcount
+    conn.commit()
     conn.close()
     logging.info(f"Categories synced. Total inserted/updated: {total_changes}")
 
 # Sync bills (unchanged)
 def sync_bills(last_sync_time=None):
     logging.info("Fetching bills...")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    page = 1
-    total_changes = 0
-    
-    while True:
-        endpoint = f"/bills?page={page}"
-        if last_sync_time:
-            endpoint += f"&updated_at={last_sync_time}"
-        data = call_firefly_api_curl(endpoint)
-        if not data or "data" not in data:
-            logging.error("No valid bill data returned.")
-            break
-
-        page_data = data["data"]
-        if not page_data:
-            logging.info(f"No more bills to fetch at page {page}.")
-            break
-
-        for item in page_data:
-            bill_id = int(item["id"])
-            attrs = item["attributes"]
-            name = attrs.get("name", "")
-            amount_min = float(attrs.get("amount_min", 0.0))
-            amount_max = float(attrs.get("amount_max", 0.0))
-            last_updated = attrs.get("updated_at", "")
-
-            result = cur.execute('''
-                INSERT OR REPLACE INTO bills (id, name, amount_min, amount_max, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (bill_id, name, amount_min, amount_max, last_updated))
-            total_changes += result.rowcount
-
-        conn.commit()
-        page += 1
+    items = fetch_all_pages("/bills", last_sync_time)
+    if items is None:
+        logging.error("No valid bill data returned.")
+        return
 
+    conn = connect()
+    cur = conn.cursor()
+    rows = []
+    for item in items:
+        bill_id = int(item["id"])
+        attrs = item["attributes"]
+        name = attrs.get("name", "")
+        amount_min = float(attrs.get("amount_min", 0.0))
+        amount_max = float(attrs.get("amount_max", 0.0))
+        last_updated = attrs.get("updated_at", "")
+
+        rows.append((bill_id, name, amount_min, amount_max, last_updated))
+
+    cur.execute("BEGIN IMMEDIATE")
+    cur.executemany(_SQL_INSERT_BILL, rows)
+    total_changes = cur.rowcount
+    conn.commit()
     conn.close()
     logging.info(f"Bills synced. Total inserted/updated: {total_changes}")
 
 def sync_transactions(last_sync_time=None):
     logging.info("Fetching transactions...")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    page = 1
-    total_changes = 0
-    
-    while True:
-        endpoint = f"/transactions?page={page}"
-        if last_sync_time:
-            endpoint += f"&updated_at={last_sync_time}"
-        data = call_firefly_api_curl(endpoint)
-        if not data or "data" not in data:
-            logging.error("No valid transaction data returned.")
-            break
-
-        page_data = data["data"]
-        if not page_data:
-            logging.info(f"No more transactions to fetch at page {page}.")
-            break
-
-        for item in page_data:
-            trans_id = int(item["id"])
-            attrs = item["attributes"]
-            trans = attrs["transactions"][0]
-            description = trans.get("description", "")
-            amount = float(trans.get("amount", 0.0))
-            created_at = attrs.get("created_at", "")  # Fixed: Use created_at from attrs
-            source_id = int(trans.get("source_id", 0)) or None
-            destination_id = int(trans.get("destination_id", 0)) or None
-            cat_val = trans.get("category_id")
-            if cat_val is not None:
-                category_id = int(cat_val)
-            else:
-                category_id = None
-            trans_type = trans.get("type", "withdrawal")
-            source_name = trans.get("source_name", "")
-            destination_name = trans.get("destination_name", "")
-            category_name = trans.get("category_name", "")
-            last_updated = attrs.get("updated_at", "")
-            tags = trans.get("tags", []) or []
-
-            logging.info(f"Transaction {trans_id} tags: {tags}")
-
-            result = cur.execute('''
-                INSERT OR REPLACE INTO transactions (
-                    id, description, amount, created_at, source_id, destination_id, category_id, type,
-                    source_name, destination_name, category_name, last_updated
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (trans_id, description, amount, created_at, source_id, destination_id, category_id, trans_type,
-                  source_name, destination_name, category_name, last_updated))
-            total_changes += result.rowcount
-
-            for tag in tags:
-                if tag:
-                    logging.info(f"Inserting tag '{tag}' for transaction {trans_id}")
-                    cur.execute("INSERT INTO transactions_tags (transaction_id, name) VALUES (?, ?)", 
-                                (trans_id, tag))
-
-        conn.commit()
-        page += 1
+    items = fetch_all_pages("/transactions", last_sync_time)
+    if items is None:
+        logging.error("No valid transaction data returned.")
+        return
 
+    conn = connect()
+    cur = conn.cursor()
+    rows = []
+    tag_rows = []
+    for item in items:
+        trans_id = int(item["id"])
+        attrs = item["attributes"]
+        trans = attrs["transactions"][0]
+        description = trans.get("description", "")
+        amount = float(trans.get("amount", 0.0))
+        created_at = attrs.get("created_at", "")  # Fixed: Use created_at from attrs
+        source_id = int(trans.get("source_id", 0)) or None
+        destination_id = int(trans.get("destination_id", 0)) or None
+        cat_val = trans.get("category_id")
+        if cat_val is not None:
+            category_id = int(cat_val)
+        else:
+            category_id = None
+        trans_type = trans.get("type", "withdrawal")
+        source_name = trans.get("source_name", "")
+        destination_name = trans.get("destination_name", "")
+        category_name = trans.get("category_name", "")
+        last_updated = attrs.get("updated_at", "")
+        tags = trans.get("tags", []) or []
+
+        logging.info(f"Transaction {trans_id} tags: {tags}")
+
+        rows.append((trans_id, description, amount, created_at, source_id, destination_id, category_id, trans_type,
+                     source_name, destination_name, category_name, last_updated))
+
+        for tag in tags:
+            if tag:
+                logging.info(f"Inserting tag '{tag}' for transaction {trans_id}")
+                tag_rows.append((trans_id, tag))
+
+    cur.execute("BEGIN IMMEDIATE")
+    cur.executemany(_SQL_INSERT_TRANSACTION, rows)
+    total_changes = cur.rowcount
+    cur.executemany(_SQL_INSERT_TAG, tag_rows)
+    conn.commit()
     conn.close()
     logging.info(f"Transactions synced. Total inserted/updated: {total_changes}")
 
@@ -307,22 +329,35 @@ def sync_transactions(last_sync_time=None):
 # ... (rest of file unchanged)
 
 def store_transaction_embeddings():
-    logging.info("Loading pretrained SentenceTransformer: all-MiniLM-L6-v2")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    conn = sqlite3.connect(DB_PATH)
+    logging.info(f"Loading pretrained SentenceTransformer: {MODEL_NAME}")
+    model = get_model()
+    conn = connect()
     cur = conn.cursor()
     total_changes = 0
     
+    # Scalar columns and tags are fetched separately and joined in Python,
+    # which avoids a GROUP_CONCAT aggregate per transaction
     cur.execute("""
-        SELECT t.id, t.description, t.source_name, t.destination_name, t.category_name,
-               GROUP_CONCAT(tt.name, ', ') AS tags, t.amount
-        FROM transactions t
-        LEFT JOIN transactions_tags tt ON t.id = tt.transaction_id
-        WHERE t.id NOT IN (SELECT transaction_id FROM transaction_embeddings)
-        GROUP BY t.id, t.description, t.source_name, t.destination_name, t.category_name
+        SELECT id, description, source_name, destination_name, category_name, amount
+        FROM transactions
+        WHERE id NOT IN (SELECT transaction_id FROM transaction_embeddings)
     """)
     rows = cur.fetchall()
-    for trans_id, desc, src_name, dest_name, cat_name, tags, amount in rows:
+
+    cur.execute("""
+        SELECT transaction_id, name
+        FROM transactions_tags
+        WHERE transaction_id NOT IN (SELECT transaction_id FROM transaction_embeddings)
+        ORDER BY id
+    """)
+    tags_by_tid = defaultdict(list)
+    for trans_id, tag in cur.fetchall():
+        tags_by_tid[trans_id].append(tag)
+
+    trans_ids = []
+    texts = []
+    for trans_id, desc, src_name, dest_name, cat_name, amount in rows:
+        tags = ", ".join(tags_by_tid.get(trans_id, []))
         parts = [desc or ""]
         if src_name:
             parts.append(f"source {src_name}")  # Emphasize source
@@ -338,12 +373,18 @@ def store_transaction_embeddings():
             parts.append(f"amount {amount}")
         embedding_text = " ".join(parts)
         logging.info(f"Embedding text for transaction {trans_id}: {embedding_text}")
-        embedding = model.encode(embedding_text).tobytes()
-        result = cur.execute("INSERT OR REPLACE INTO transaction_embeddings (transaction_id, embedding) VALUES (?, ?)", 
-                             (trans_id, embedding))
-        total_changes += result.rowcount
-    
-    conn.commit()
+        trans_ids.append(trans_id)
+        texts.append(embedding_text)
+
+    if texts:
+        # One batched forward pass instead of one encode() call per transaction
+        embeddings = model.encode(texts, batch_size=64, convert_to_numpy=True, show_progress_bar=False)
+        cur.execute("BEGIN IMMEDIATE")
+        # Stored as int8 plus a per-row scale: a quarter of the float32 size
+        cur.executemany(_SQL_INSERT_EMBEDDING, zip(trans_ids, (embedding_to_blob(e) for e in embeddings)))
+        total_changes += cur.rowcount
+        conn.commit()
+
     conn.close()
     logging.info(f"Transaction embeddings stored. Total inserted/updated: {total_changes}")
 
@@ -359,6 +400,7 @@ def main():
     sync_bills(last_sync_time)
     sync_transactions(last_sync_time)
     store_transaction_embeddings()
+    analyze_db()
     logging.info("Sync complete!")
 
 if __name__ == "__main__":
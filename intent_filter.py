@@ -1,12 +1,15 @@
-import sqlite3
+import faiss
 import numpy as np
-import json
+import orjson
+from functools import lru_cache
 import logging
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from context_loader import build_prompt_context, load_accounts, load_bills
+from context_loader import build_prompt_context, data_version, load_bills
+from db import DB_PATH, get_ro_conn
+from embeddings import EMBEDDING_DIM, blob_to_embedding, get_model
 from dotenv import load_dotenv
 import os
 
@@ -25,46 +28,242 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPEN_AI_API_KEY")
-DB_PATH = "firefly_local.db"
+FAISS_INDEX_PATH = "firefly_local.faiss"
+# Serialises index loads so warmup and a request never build and write it twice
+_index_lock = threading.Lock()
 
 # Initialize OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
-# Initialize the sentence-transformers model
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Background workers for DB reads that overlap the OpenAI round-trip
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="intent-prefetch")
+
+# Static part of the LLM prompt. Only the tail built in determine_intent varies per
+# message, so the long shared prefix is also eligible for OpenAI prompt caching.
+_PROMPT_HEADER = """\
+You are a finance assistant that generates a structured Firefly III transaction.
+
+-----------
+
+## FINAL Firefly Payload Format:
+
+payload = {
+"transactions": [
+    {
+        "type": "(string: 'bill'|'withdrawal'|'transfer'|'deposit')",
+        "amount": "(string or number)",
+        "description": "(short descriptive text)",
+        "source_id": "(number, or unknown if not inferred)",
+        "destination_id": "(number, or unknown if not inferred)",
+        "currency_code": "(string, e.g. 'JPY' or 'USD')",
+        "date": "(string: 'YYYY-MM-DD', always use today's date from Python)",
+        "category_name": "(string)",
+        "bill_id": "(number, or unknown if not a bill payment)",
+        "tags": "(array of strings, relevant to the transaction, e.g., 'shopping', 'amazon')",
+        "notes": "Created by Firefly Assistant"
+    }
+]
+}
+
+-----------
+
+## INSTRUCTIONS:
+
+1) Determine "type" from user context:
+- "withdrawal" if expense or bill
+- "deposit" if money in
+- "transfer" if moving between personal accounts
+
+2) If the user doesn't specify "amount" or "source_id"/"destination_id", try to infer from context or from the known accounts list. If still unknown, mark them in "missing_info".
+- "withdrawal" and bill usually only have source id
+- "deposit" usually only have destination id
+- "transfer" has both
+
+3) "currency_code":
+- "JPY" if user says "yen"
+- "USD" if user says "dollar" or if uncertain
+
+4) "description":
+- Make it more descriptive than the user’s raw input if possible.
+- Possibly incorporate context from "previous_description".
+
+5) "tags":
+- Always include the user-specified tags given under INPUT DATA.
+- If no user-specified tags, use only tags from "KNOWN TAGS" (strict matching).
+
+6) "category_name":
+- If user or context suggests a category, fill it in. Else, can remain empty.
+
+7) "notes":
+- Always "Created by Firefly Assistant".
+
+8) "date":
+- Always use today's date from Python.
+
+9) "bill_id":
+- If the transaction is a bill payment, include the bill ID stricly from the known bills list.
+
+9) Output must be a **valid JSON** object with exactly these top-level keys:
+{
+    "type": "string",
+    "amount": "string",
+    "description": "string",
+    "source_id": "string or number",
+    "destination_id": "string or number",
+    "currency_code": "string",
+    "date": "string (YYYY-MM-DD)",
+    "category_name": "string",
+    "tags": ["array","of","strings"],
+    "missing_info": ["array","of","strings"],
+    "bill_id": "string or number"
+}
+
+NOTE: "missing_info" is for any fields you truly cannot infer.
+If "source_id" is unknown, put "source_id" in there, etc.
+
+Return ONLY that JSON object, with NO extra keys.
+
+Example valid output:
+{
+"type": "deposit",
+"amount": "1000",
+"description": "Topup to PayPay account",
+"source_id": 1,
+"destination_id": 16,
+"currency_code": "USD",
+"date": "2023-10-05",
+"category_name": "Topup",
+"tags": ["paypay", "foramazon"],
+"missing_info": []
+}
+
+-----------
+
+## KNOWN ACCOUNTS:
+These are the user’s existing Firefly accounts (name → ID). If the user input references any of these names (case-insensitive), set the matching ID accordingly.
+"""
+
+@lru_cache(maxsize=1)
+def _prompt_prefix(context_snippet):
+    """Static prompt header followed by the (memoized) known-data context."""
+    return _PROMPT_HEADER + "\n" + context_snippet + "\n"
 
 def load_account_cache():
-    """Load account names/IDs from SQLite into a dict."""
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Load account names/IDs from SQLite into a dict keyed by both the lowercase
+    account name and the account ID as a string, so a source/destination the
+    LLM returns either way resolves. Cached until the synced data changes.
+    """
+    return _load_account_cache(data_version())
+
+@lru_cache(maxsize=1)
+def _load_account_cache(version):
+    conn = get_ro_conn()
     cur = conn.cursor()
     cur.execute("SELECT id, name, type FROM accounts")
-    account_cache = {name.lower(): {"id": acc_id, "type": acc_type}
-                     for acc_id, name, acc_type in cur.fetchall()}
-    conn.close()
+    rows = cur.fetchall()
+    account_cache = {name.lower(): {"id": acc_id, "name": name, "type": acc_type}
+                     for acc_id, name, acc_type in rows if name}
+    # IDs win over an account whose name happens to look like an ID
+    account_cache.update({str(acc_id): {"id": acc_id, "name": name, "type": acc_type}
+                          for acc_id, name, acc_type in rows})
     return account_cache
 
-account_cache = load_account_cache()
+def _embedding_version():
+    """Fingerprint of transaction_embeddings; changes when the sync adds rows."""
+    cur = get_ro_conn().cursor()
+    cur.execute("SELECT COUNT(*), MAX(transaction_id) FROM transaction_embeddings")
+    return cur.fetchone()
+
+def _read_embedding_matrix():
+    """
+    Load every stored embedding into one (N, dim) float32 matrix with
+    L2-normalized rows, so inner product equals cosine similarity.
+    """
+    cur = get_ro_conn().cursor()
+    cur.execute("SELECT COUNT(*) FROM transaction_embeddings")
+    (total,) = cur.fetchone()
+
+    # Decode each BLOB straight into a preallocated row instead of building a
+    # list of per-row arrays and copying them again with vstack
+    ids = np.empty(total, dtype=np.int64)
+    matrix = np.empty((total, EMBEDDING_DIM), dtype=np.float32)
+    count = 0
+    for tid, emb in cur.execute("SELECT transaction_id, embedding FROM transaction_embeddings"):
+        if count == total:
+            break
+        try:
+            blob_to_embedding(emb, out=matrix[count])
+        except ValueError as e:
+            logger.error(f"Skipping embedding for transaction {tid}: {e}")
+            continue
+        ids[count] = tid
+        count += 1
+
+    ids = ids[:count]
+    matrix = matrix[:count]
+    if not count:
+        return ids, matrix
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return ids, matrix
+
+def _read_persisted_index(version):
+    """Return the FAISS index saved on disk if it matches `version`, else None."""
+    if not os.path.exists(FAISS_INDEX_PATH):
+        return None
+    try:
+        index = faiss.read_index(FAISS_INDEX_PATH)
+    except RuntimeError as e:
+        logger.error(f"Could not read {FAISS_INDEX_PATH}: {e}")
+        return None
+
+    count, max_tid = version
+    if index.ntotal != count:
+        return None
+    if count and int(faiss.vector_to_array(index.id_map).max()) != max_tid:
+        return None
+    return index
+
+@lru_cache(maxsize=1)
+def _load_embedding_index(version):
+    """
+    Return a FAISS inner-product index over the stored embeddings, keyed by
+    transaction ID. The index is persisted next to the database and only
+    rebuilt when transaction_embeddings has changed since it was written.
+    """
+    index = _read_persisted_index(version)
+    if index is not None:
+        logger.info(f"Loaded embedding index with {index.ntotal} transactions from {FAISS_INDEX_PATH}")
+        return index
+
+    ids, matrix = _read_embedding_matrix()
+    index = faiss.IndexIDMap(faiss.IndexFlatIP(EMBEDDING_DIM))
+    if len(ids):
+        index.add_with_ids(matrix, ids)
+    try:
+        tmp_path = f"{FAISS_INDEX_PATH}.tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, FAISS_INDEX_PATH)
+    except (RuntimeError, OSError) as e:
+        logger.error(f"Could not persist {FAISS_INDEX_PATH}: {e}")
+    logger.info(f"Built embedding index with {index.ntotal} transactions")
+    return index
 
 def find_similar_transactions(desc, top_k=3):
     """Find the top-k most similar transactions by embedding similarity."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    embedding = model.encode(desc)
-
-    cur.execute("SELECT transaction_id, embedding FROM transaction_embeddings")
-    rows = cur.fetchall()
-    similarities = []
-    for tid, emb in rows:
-        try:
-            emb_array = np.frombuffer(emb, dtype=np.float32)
-            similarity = cosine_similarity([embedding], [emb_array])[0][0]
-            similarities.append((tid, similarity))
-        except Exception as e:
-            logger.error(f"Error processing embedding for transaction {tid}: {e}")
+    version = _embedding_version()
+    with _index_lock:
+        index = _load_embedding_index(version)
+    if not index.ntotal:
+        return []
 
-    conn.close()
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return similarities[:top_k]
+    query = np.asarray(get_model().encode(desc), dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(query)
+    scores, tids = index.search(query, min(top_k, index.ntotal))
+    return [(int(tid), float(score)) for tid, score in zip(tids[0], scores[0]) if tid != -1]
 
 def extract_tags_from_input(user_input):
     """
@@ -80,6 +279,9 @@ def extract_tags_from_input(user_input):
     return user_input, []
 
 def determine_intent(user_input):
+    # Always use today's date, computed once per request
+    today = datetime.date.today().isoformat()
+
     # Extract user-specified tags
     user_input, user_tags = extract_tags_from_input(user_input)
 
@@ -99,7 +301,7 @@ def determine_intent(user_input):
 
     if similar_tids:
         best_tid = similar_tids[0][0]
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_ro_conn()
         cur = conn.cursor()
         cur.execute("""
             SELECT t.description, t.amount, t.source_name, t.destination_name, t.category_name
@@ -110,7 +312,6 @@ def determine_intent(user_input):
 
         cur.execute("SELECT name FROM transactions_tags WHERE transaction_id = ?", (best_tid,))
         tag_rows = cur.fetchall()
-        conn.close()
 
         if row:
             context_info["previous_description"] = row[0]
@@ -126,133 +327,39 @@ def determine_intent(user_input):
     similar_context = ""
     if similar_tids:
         best_tid = similar_tids[0][0]
-        similar_context = f"""
-        - previous_description: {context_info['previous_description']}
-        - typical_amount: {context_info['typical_amount']}
-        - common_source: {context_info['common_source']}
-        - common_destination: {context_info['common_destination']}
-        - common_category: {context_info['common_category']}
-        - common_tags: {context_info['common_tags']}
-        """
-
-    prompt = f"""
-        You are a finance assistant that generates a structured Firefly III transaction.
-
-        -----------
-
-        ## FINAL Firefly Payload Format:
-
-        payload = {{
-        "transactions": [
-            {{
-                "type": "(string: 'bill'|'withdrawal'|'transfer'|'deposit')",
-                "amount": "(string or number)",
-                "description": "(short descriptive text)",
-                "source_id": "(number, or unknown if not inferred)",
-                "destination_id": "(number, or unknown if not inferred)",
-                "currency_code": "(string, e.g. 'JPY' or 'USD')",
-                "date": "(string: 'YYYY-MM-DD', always use today's date from Python)",
-                "category_name": "(string)",
-                "bill_id": "(number, or unknown if not a bill payment)",
-                "tags": "(array of strings, relevant to the transaction, e.g., 'shopping', 'amazon')",
-                "notes": "Created by Firefly Assistant"
-            }}
-        ]
-        }}
-
-        -----------
-
-        ## KNOWN ACCOUNTS:
-        These are the user’s existing Firefly accounts (name → ID). If the user input references any of these names (case-insensitive), set the matching ID accordingly.
-
-        {context_snippet}
-
-        -----------
-
-        ## INPUT DATA:
-
-        1) **User message**:
-        {user_input}
-
-        2) **Similar transaction context**:
-        {similar_context}
-        -----------
-
-        ## INSTRUCTIONS:
-
-        1) Determine "type" from user context:
-        - "withdrawal" if expense or bill
-        - "deposit" if money in
-        - "transfer" if moving between personal accounts
-
-        2) If the user doesn't specify "amount" or "source_id"/"destination_id", try to infer from context or from the known accounts list. If still unknown, mark them in "missing_info".
-        - "withdrawal" and bill usually only have source id
-        - "deposit" usually only have destination id
-        - "transfer" has both
-
-        3) "currency_code":
-        - "JPY" if user says "yen"
-        - "USD" if user says "dollar" or if uncertain
-
-        4) "description":
-        - Make it more descriptive than the user’s raw input if possible.
-        - Possibly incorporate context from "previous_description".
-
-        5) "tags":
-        - Always include user-specified tags: {user_tags}.
-        - If no user-specified tags, use only tags from "KNOWN TAGS" (strict matching).
-
-        6) "category_name":
-        - If user or context suggests a category, fill it in. Else, can remain empty.
-
-        7) "notes":
-        - Always "Created by Firefly Assistant".
-
-        8) "date":
-        - Always use today's date from Python.
-
-        9) "bill_id":
-        - If the transaction is a bill payment, include the bill ID stricly from the known bills list.
-
-        9) Output must be a **valid JSON** object with exactly these top-level keys:
-        {{
-            "type": "string",
-            "amount": "string",
-            "description": "string",
-            "source_id": "string or number",
-            "destination_id": "string or number",
-            "currency_code": "string",
-            "date": "string (YYYY-MM-DD)",
-            "category_name": "string",
-            "tags": ["array","of","strings"],
-            "missing_info": ["array","of","strings"],
-            "bill_id": "string or number"
-        }}
-
-        NOTE: "missing_info" is for any fields you truly cannot infer.
-        If "source_id" is unknown, put "source_id" in there, etc.
-
-        Return ONLY that JSON object, with NO extra keys.
-
-        Example valid output:
-        {{
-        "type": "deposit",
-        "amount": "1000",
-        "description": "Topup to PayPay account",
-        "source_id": 1,
-        "destination_id": 16,
-        "currency_code": "USD",
-        "date": "2023-10-05",
-        "category_name": "Topup",
-        "tags": ["paypay", "foramazon"],
-        "missing_info": []
-        }}
-
-        -----------
-
-        ## TASK:
-        Return exactly one JSON object following the specification above.
-    """
+        similar_context = (
+            f"- previous_description: {context_info['previous_description']}\n"
+            f"- typical_amount: {context_info['typical_amount']}\n"
+            f"- common_source: {context_info['common_source']}\n"
+            f"- common_destination: {context_info['common_destination']}\n"
+            f"- common_category: {context_info['common_category']}\n"
+            f"- common_tags: {context_info['common_tags']}"
+        )
+
+    prompt = _prompt_prefix(context_snippet) + f"""
+-----------
+
+## INPUT DATA:
+
+1) **User message**:
+{user_input}
+
+2) **Similar transaction context**:
+{similar_context}
+
+3) **User-specified tags**:
+{user_tags}
+
+-----------
+
+## TASK:
+Return exactly one JSON object following the specification above.
+"""
+
+    # The account and bill maps are always needed once the LLM answers, so
+    # load them in the background while the request is in flight
+    accounts_future = _prefetch_pool.submit(load_account_cache)
+    bills_future = _prefetch_pool.submit(load_bills)
 
     # 3) Call OpenAI
     logger.info("Prompt to LLM:\n%s", prompt)
@@ -260,6 +367,7 @@ def determine_intent(user_input):
         response = client.chat.completions.create(
             model="gpt-4o-mini",  # or your chosen model name
             messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
             temperature=0.4
         )
         response_str = response.choices[0].message.content.strip()
@@ -270,8 +378,8 @@ def determine_intent(user_input):
 
     # 4) Parse the JSON
     try:
-        data = json.loads(response_str)
-    except json.JSONDecodeError:
+        data = orjson.loads(response_str)
+    except orjson.JSONDecodeError:
         logger.error("LLM did not return valid JSON.")
         return None
 
@@ -280,37 +388,32 @@ def determine_intent(user_input):
     if not isinstance(missing_info, list):
         missing_info = []
 
-    # Always use today's date
-    date_str = datetime.date.today().isoformat()
+    # Resolve accounts by ID or (lowercase) name
+    account_cache = accounts_future.result()
+    source = account_cache.get(str(data.get("source_id", "unknown")).strip().lower())
+    destination = account_cache.get(str(data.get("destination_id", "unknown")).strip().lower())
+    logger.info(f"Source account: {source}, Destination account: {destination}")
 
-    # Load account mapping
-    account_map = load_accounts()
-    logger.info(f"Loaded account map: {account_map}")
-
-    # Load bill mapping
-    bill_map = load_bills()
-    bill_id = str(data.get("bill_id", "unknown")).lower()
+    # Load bill mapping (keyed by integer bill ID)
+    bill_map = bills_future.result()
+    bill_key = str(data.get("bill_id", "unknown")).strip()
+    bill = bill_map.get(int(bill_key), {}) if bill_key.isdigit() else {}
     logger.info(f"Loaded bill map: {bill_map}")
 
-    # Debugging source_id and destination_id
-    source_id = str(data.get("source_id", "unknown")).lower()
-    destination_id = str(data.get("destination_id", "unknown")).lower()
-    logger.info(f"Source ID: {source_id}, Destination ID: {destination_id}")
-
     # Return a dictionary with consistent keys
     result = {
         "type": data.get("type", "withdrawal"),
         "amount": str(data.get("amount", "0")),
         "description": data.get("description", user_input),
-        "source_id": data.get("source_id", "unknown"),
-        "destination_id": data.get("destination_id", "unknown"),
-        "source_name": account_map.get(source_id, ""),
-        "destination_name": account_map.get(destination_id, ""),
+        "source_id": source["id"] if source else data.get("source_id", "unknown"),
+        "destination_id": destination["id"] if destination else data.get("destination_id", "unknown"),
+        "source_name": source["name"] if source else "",
+        "destination_name": destination["name"] if destination else "",
         "currency_code": data.get("currency_code", "USD"),
-        "date": date_str,
+        "date": today,
         "category_name": data.get("category_name", ""),
         "tags": list(set(user_tags + data.get("tags", []))),  # Combine user-specified and GPT-generated tags
-        "bill_name": bill_map.get(bill_id, {}).get("name", ""),
+        "bill_name": bill.get("name", ""),
         "bill_id": data.get("bill_id", "unknown"),
         "missing_info": missing_info
     }
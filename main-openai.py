@@ -1,13 +1,15 @@
 import os
-import re
-import json
+import orjson
+import time
 import asyncio
-import subprocess
 import datetime
+from dataclasses import dataclass
+from typing import List, Optional
+import httpx
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError
 
 load_dotenv()
 
@@ -15,67 +17,141 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 FIREFLY_API_TOKEN = os.getenv("FIREFLY_API_TOKEN")
 FIREFLY_API_URL = os.getenv("FIREFLY_API_URL")
 OPENAI_API_KEY = os.getenv("OPEN_AI_API_KEY")
+DEBUG = os.getenv("BOT_DEBUG") == "1"  # echo accounts/prompts back to the chat
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# SDK retries are off: create_chat_completion owns the retry/backoff policy, and
+# its sleeps happen outside the concurrency slots.
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+GPT_WORKERS = 4       # concurrent chat completions in flight
+GPT_MAX_RETRIES = 3   # attempts after a 429 before giving up
+_gpt_slots = asyncio.Semaphore(GPT_WORKERS)
+
+async def create_chat_completion(**kwargs):
+    """
+    Run a chat completion without blocking the event loop. At most GPT_WORKERS
+    requests run at once; a 429 waits for the server's retry-after (or an
+    exponential backoff) and retries up to GPT_MAX_RETRIES times.
+    """
+    for attempt in range(GPT_MAX_RETRIES + 1):
+        async with _gpt_slots:
+            try:
+                return await client.chat.completions.create(**kwargs)
+            except RateLimitError as e:
+                if attempt == GPT_MAX_RETRIES:
+                    raise
+                retry_after = e.response.headers.get("retry-after")
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = 2 ** attempt
+        print(f"[GPT] Rate limited, retrying in {delay}s")
+        await asyncio.sleep(delay)
 
 ########################################
 # 1. Firefly III API helper
 ########################################
 
-def call_firefly_api_curl(endpoint, method="GET", data=None):
-    url = f"{FIREFLY_API_URL.rstrip('/')}" + "/" + endpoint.lstrip('/')
-    token = FIREFLY_API_TOKEN
-    curl_cmd = [
-        "curl", "-X", method, url,
-        "-H", f"Authorization: Bearer {token}",
-        "-H", "Accept: application/json"
-    ]
-    if method == "POST" and data:
-        curl_cmd += ["-H", "Content-Type: application/json", "-d", json.dumps(data)]
-    result = subprocess.run(curl_cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"[Firefly API Error] {result.stderr}")
+# Shared async HTTP client: pooled keep-alive connections to Firefly that
+# don't block the event loop. Closed in the application's post_shutdown hook.
+_http = httpx.AsyncClient(
+    base_url=FIREFLY_API_URL or "",
+    headers={"Authorization": f"Bearer {FIREFLY_API_TOKEN}", "Accept": "application/json"},
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    timeout=10.0,
+)
+
+async def call_firefly_api(endpoint, method="GET", data=None):
+    try:
+        if data is None:
+            response = await _http.request(method, endpoint)
+        else:
+            response = await _http.request(method, endpoint, content=orjson.dumps(data),
+                                           headers={"Content-Type": "application/json"})
+    except httpx.HTTPError as e:
+        print(f"[Firefly API Error] {e}")
         return None
-    raw_response = result.stdout
+    raw_response = response.text
     print("[Firefly API Response]", raw_response)
     try:
-        return json.loads(raw_response)
-    except json.JSONDecodeError:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
         print("[Firefly API Warning] Failed to parse JSON:", raw_response)
         return raw_response
 
-########################################
-# 2. Utility for parsing multiline key-value
-########################################
-def parse_key_value_response(response_text: str) -> dict:
-    """Parses a multiline key=value response into a dict. Ignores lines without '='."""
-    result = {}
-    for line in response_text.strip().splitlines():
-        if '=' in line:
-            key, val = line.split('=', 1)
-            result[key.strip()] = val.strip()
-    return result
-
-########################################
-# 3. Single GPT Prompt that returns multiline key=val
-########################################
-import difflib
-
-async def parse_financial_message(user_input: str, accounts_str: str, update: Update):
+@dataclass(frozen=True)
+class Accounts:
+    """Firefly accounts as parallel columns, plus the block of lines fed to GPT."""
+    ids: List[int]
+    names: List[str]
+    types: List[str]
+    currencies: List[str]
+    prompt_block: str  # one "id:..,name:..,type:..,currency:.." line per account
+
+@dataclass(frozen=True)
+class FireflyContext:
+    """Everything the prompt needs from Firefly, fetched together."""
+    accounts: Accounts
+    categories: List[str]
+    bills: List[str]
+
+CONTEXT_TTL = 120  # seconds
+_context_cache = {}  # time bucket -> FireflyContext
+
+def _names(response) -> List[str]:
+    """Names from a Firefly list response, or [] if the call failed."""
+    if not isinstance(response, dict):
+        return []
+    return [item["attributes"]["name"] for item in response.get("data", [])]
+
+def _build_accounts(data) -> Accounts:
+    ids = [int(a["id"]) for a in data]
+    names = [a["attributes"]["name"] for a in data]
+    types = [a["attributes"]["type"] for a in data]
+    currencies = [a["attributes"]["currency_code"] for a in data]
+    prompt_block = "\n".join(
+        f"id:{i},name:{n},type:{t},currency:{c}" for i, n, t, c in zip(ids, names, types, currencies)
+    )
+    return Accounts(ids, names, types, currencies, prompt_block)
+
+async def get_context() -> Optional[FireflyContext]:
     """
-    Single GPT call that returns all needed fields (type, amount, currency, source_id, destination_id, etc.)
-    in a multiline key-value format. e.g.:
-      type=withdrawal\namount=500\n...
-    We'll also print the prompt to the user for debugging.
+    Return the Firefly accounts, categories and bills used in the prompt.
+    The three GETs run concurrently, and the result is reused for CONTEXT_TTL
+    seconds so bursts of messages don't each refetch and rebuild it. Returns
+    None if the accounts can't be fetched; categories and bills are optional.
     """
-    today = datetime.date.today().isoformat()
+    bucket = int(time.monotonic() // CONTEXT_TTL)
+    cached = _context_cache.get(bucket)
+    if cached is not None:
+        return cached
+
+    accounts_response, categories_response, bills_response = await asyncio.gather(
+        call_firefly_api("/accounts?type=asset,expense,revenue"),
+        call_firefly_api("/categories"),
+        call_firefly_api("/bills"),
+    )
+    if not isinstance(accounts_response, dict) or "data" not in accounts_response:
+        return None
 
-    prompt = f"""
-You are a finance assistant. A user wrote this message: "{user_input}".
-We have these known Firefly accounts (id, name, type, currency):
-{accounts_str}
+    ctx = FireflyContext(
+        accounts=_build_accounts(accounts_response["data"]),
+        categories=_names(categories_response),
+        bills=_names(bills_response),
+    )
+    _context_cache.clear()
+    _context_cache[bucket] = ctx
+    return ctx
 
-Output multiline key=value pairs, one per line, with no extra text, using these keys:
+########################################
+# 2. Static GPT instructions (sent as the system message)
+########################################
+SYSTEM_PROMPT = """
+You are a finance assistant. The user message lists the known Firefly accounts
+(id, name, type, currency), categories and bills, the user's text and today's date.
+
+Reply with a single JSON object, no extra text, using these keys:
 - type (withdrawal|deposit|transfer)
 - description
 - amount
@@ -83,44 +159,69 @@ Output multiline key=value pairs, one per line, with no extra text, using these
 - category_name
 - source_id
 - destination_id
-- tags (comma-separated if multiple)
+- tags (a list of strings)
 - date
 
 Rules:
-- If user text suggests paying rent for 'apato', use tags like "housing,rent" and category "Housing".
-- If user text suggests restaurant/food (like sukiya), use tags like "food" and category "Food".
+- If user text suggests paying rent for 'apato', use tags like ["housing", "rent"] and category "Housing".
+- If user text suggests restaurant/food (like sukiya), use tags like ["food"] and category "Food".
 - If user text indicates a deposit or income, set type=deposit.
 - If user text is a "bill", set type=withdrawal and add "bill" to tags.
 - For withdrawals: source=asset, destination=expense.
 - For deposits: source=revenue/asset, destination=asset.
 - For transfers: source=asset, destination=asset.
 - If no match for user-specified account, guess the best or use "0".
+- Prefer one of the known categories for category_name; if the text pays a known bill, add "bill" to tags.
 - If currency is unknown, default to "USD".
-- Use today's date {today} for date.
+- Use the given date for date.
 
 Example:
-  type=withdrawal\ndescription=Apartment Payment\namount=30000\ncurrency_code=USD\ncategory_name=Housing\nsource_id=? (an asset account id)\ndestination_id=? (an expense account id)\ntags=housing,rent\ndate={today}
-
+  {"type": "withdrawal", "description": "Apartment Payment", "amount": "30000", "currency_code": "USD",
+   "category_name": "Housing", "source_id": "<an asset account id>", "destination_id": "<an expense account id>",
+   "tags": ["housing", "rent"], "date": "<date>"}
 """
 
-    # Print the prompt to console
-    print("[GPT Prompt]", prompt)
-    # Optionally, also show it to the user (shortened if needed)
-    short_prompt = (prompt[:4000] + '...') if len(prompt) > 4000 else prompt
-    await update.message.reply_text(f"[DEBUG] Prompt sent to GPT:\n{short_prompt}")
+########################################
+# 3. Single GPT call that returns a JSON object
+########################################
+
+async def parse_financial_message(user_input: str, ctx: FireflyContext, today: str, update: Update):
+    """
+    Single GPT call that returns all needed fields (type, amount, currency, source_id, destination_id, etc.)
+    as a JSON object. Values are returned as strings, with tags joined by commas.
+    We'll also print the prompt to the user for debugging.
+    """
+    prompt = (
+        f"accounts:\n{ctx.accounts.prompt_block}\n"
+        f"categories: {', '.join(ctx.categories)}\n"
+        f"bills: {', '.join(ctx.bills)}\n"
+        f"message: {user_input}\ndate: {today}"
+    )
+
+    if DEBUG:
+        # Print the prompt to console and show it to the user (shortened if needed)
+        print("[GPT Prompt]", prompt)
+        short_prompt = (prompt[:4000] + '...') if len(prompt) > 4000 else prompt
+        await update.message.reply_text(f"[DEBUG] Prompt sent to GPT:\n{short_prompt}")
 
     try:
-        response = client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            response_format={"type": "json_object"},
             temperature=0.3
         )
-        content = response.choices[0].message.content.strip()
+        content = response.choices[0].message.content
         print("[GPT Raw Response]", content)
 
-        # Now parse the multiline key=val
-        data = parse_key_value_response(content)
-        return data
+        parsed = orjson.loads(content)
+        return {
+            key: ",".join(map(str, val)) if isinstance(val, list) else ("" if val is None else str(val))
+            for key, val in parsed.items()
+        }
     except Exception as e:
         print("[GPT Error]", str(e))
         return None
@@ -131,54 +232,44 @@ Example:
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
+    today_iso = datetime.date.today().isoformat()
 
-    # 4a) Fetch Firefly accounts
-    accounts_response = call_firefly_api_curl("/accounts?type=asset,expense,revenue")
-    if not accounts_response or "data" not in accounts_response:
-        await update.message.reply_text("❌ Could not fetch accounts from Firefly.")
-        return
+    # One status message, edited in place as the request progresses
+    status = await update.message.reply_text("⏳ Parsing...")
 
-    # Build an easy-to-use text list for GPT
-    accounts_list = []
-    for account_item in accounts_response["data"]:
-        aid = account_item["id"]
-        attrs = account_item["attributes"]
-        name = attrs["name"]
-        atype = attrs["type"]
-        currency = attrs["currency_code"]
-        accounts_list.append(f"id:{aid},name:{name},type:{atype},currency:{currency}")
-
-    # Show user the known accounts for clarity
-    if accounts_list:
-        preview_accounts = "\n".join(accounts_list)
-        await update.message.reply_text(f"[DEBUG] We have {len(accounts_list)} Firefly accounts:\n{preview_accounts}")
-    else:
-        await update.message.reply_text("[DEBUG] No Firefly accounts found.")
+    # 4a) Fetch Firefly accounts, categories and bills (cached for CONTEXT_TTL seconds)
+    ctx = await get_context()
+    if ctx is None:
+        await status.edit_text("❌ Could not fetch accounts from Firefly.")
+        return
+    accounts = ctx.accounts
 
-    accounts_str = "\n".join(accounts_list)
+    # Show user the known accounts for clarity (debug only: it costs an extra Telegram round-trip)
+    if DEBUG:
+        if accounts.ids:
+            await update.message.reply_text(f"[DEBUG] We have {len(accounts.ids)} Firefly accounts:\n{accounts.prompt_block}")
+        else:
+            await update.message.reply_text("[DEBUG] No Firefly accounts found.")
 
     # 4b) Single GPT call to parse user input
-    parsed = await parse_financial_message(user_input, accounts_str, update)
+    parsed = await parse_financial_message(user_input, ctx, today_iso, update)
     if not parsed:
-        await update.message.reply_text("❌ Failed to parse your message.")
+        await status.edit_text("❌ Failed to parse your message.")
         return
 
     # 4c) Validate the GPT response
     required_keys = ["type", "amount", "description", "currency_code", "source_id", "destination_id", "date"]
     for k in required_keys:
         if k not in parsed:
-            await update.message.reply_text(f"❌ Missing field '{k}' in GPT response.")
+            await status.edit_text(f"❌ Missing field '{k}' in GPT response.")
             return
 
     amount = parsed.get("amount", "").strip()
     src_id = parsed.get("source_id", "").strip()
     dst_id = parsed.get("destination_id", "").strip()
     if not amount or amount in ["0", "unknown"]:
-        await update.message.reply_text("❌ No valid amount. Please specify the amount.")
+        await status.edit_text("❌ No valid amount. Please specify the amount.")
         return
-    # 0 means GPT couldn't find a matching account
-    if src_id == "0" or dst_id == "0":
-        await update.message.reply_text("⚠️ GPT set an account to '0'. You may want to correct or specify the right account.")
 
     # 4d) Build transaction payload
     # For tags, GPT might output them as comma-separated in 'tags'
@@ -195,7 +286,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "source_id": src_id,
                 "destination_id": dst_id,
                 "currency_code": parsed.get("currency_code", "USD"),
-                "date": parsed.get("date", datetime.date.today().isoformat()),
+                "date": parsed.get("date", today_iso),
                 "tags": tags_list
             }
         ]
@@ -213,22 +304,45 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                f"Currency: {t['currency_code']}\n"\
                f"Date: {t['date']}\n"\
                f"Tags: {', '.join(t['tags'])}")
-    await update.message.reply_text(preview)
+    # 0 means GPT couldn't find a matching account
+    if src_id == "0" or dst_id == "0":
+        preview += "\n\n⚠️ GPT set an account to '0'. You may want to correct or specify the right account."
+    await status.edit_text(preview)
 
     # 4f) Post to Firefly
-    response = call_firefly_api_curl("/transactions", method="POST", data=transaction_payload)
+    response = await call_firefly_api("/transactions", method="POST", data=transaction_payload)
     if response and "data" in response:
-        await update.message.reply_text("✅ Transaction posted successfully!")
+        await status.edit_text(f"{preview}\n\n✅ Transaction posted successfully!")
     else:
-        await update.message.reply_text("❌ Failed to post transaction.")
+        await status.edit_text(f"{preview}\n\n❌ Failed to post transaction.")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("👋 Hi! Send me an expense like '768 yen sukiya' or '30000 apato rent'!")
 
 
+async def on_startup(app: Application):
+    # Open the Firefly connection in the background so the first message reuses it
+    app.create_task(call_firefly_api("/about"))
+
+async def on_shutdown(app: Application):
+    await _http.aclose()
+
+
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    try:
+        import uvloop  # faster event loop for the polling and HTTP callbacks
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
@@ -1,7 +1,12 @@
 import os
-import json
+import asyncio
+import orjson
 import logging
+import copy
 import datetime
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -9,51 +14,171 @@ from telegram.ext import (
     ContextTypes, filters
 )
 
-import sqlite3
+import httpx
 
 import intent_filter  # the updated file above
-from firefly_sync import call_firefly_api_curl  # Import the function
+from context_loader import data_version
+from db import get_ro_conn
+import warmup
 
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 FIREFLY_API_URL = os.getenv("FIREFLY_API_URL")
 FIREFLY_API_TOKEN = os.getenv("FIREFLY_API_TOKEN")
-AUTHORIZED_USERS = set(map(int, os.getenv("AUTHORIZED_USERS", "").split(","))) if os.getenv("AUTHORIZED_USERS") else set()
+AUTHORIZED_USERS = frozenset(int(x) for x in os.getenv("AUTHORIZED_USERS", "").split(",") if x.strip())
 
 logging.getLogger("telegram").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext").setLevel(logging.WARNING)
 
+# Shared async HTTP client: pooled keep-alive connections to Firefly that
+# don't block the event loop. Closed in the application's post_shutdown hook.
+_http = httpx.AsyncClient(
+    base_url=FIREFLY_API_URL or "",
+    headers={"Authorization": f"Bearer {FIREFLY_API_TOKEN}", "Accept": "application/json"},
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    timeout=10.0,
+)
+
+async def call_firefly_api(endpoint, method="GET", data=None):
+    """Call the Firefly API and return the parsed JSON body (errors included), or None."""
+    try:
+        if data is None:
+            response = await _http.request(method, endpoint)
+        else:
+            response = await _http.request(method, endpoint, content=orjson.dumps(data),
+                                           headers={"Content-Type": "application/json"})
+    except httpx.HTTPError as e:
+        logging.error(f"API call failed with error: {e}")
+        return None
+    if not response.content:
+        return None
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        logging.error(f"Failed to parse API response: {response.text}")
+        return None
+
+# Proposal summaries and their keyboards never change, so build them once.
+PROPOSAL_TMPL = (
+    "Proposed Transaction"
+    "📋 Type:{type}\n"
+    "💰 Amount: {amount} {currency_code}\n"
+    "📝 Description: {description}\n"
+    "🏦 Source: {source_name}(ID: {source_id})\n"
+    "📤 Destination: {destination_name} (ID: {destination_id})\n"
+    "📂 Category: {category_name}\n"
+    "🏷️ Tags: {tags} \n"
+    "🧾 Bill: {bill_name} (ID: {bill_id})\n"
+    "❓ Missing Info: {missing_info}\n"
+    "📅 Date: {date} \n"
+)
+
+PROPOSAL_AFTER_PICK_TMPL = (
+    "🚀 Updated transaction:\n"
+    "Type: {type}\n"
+    "Amount: {amount} {currency_code}\n"
+    "Description: {description}\n"
+    "Source ID: {source_id}\n"
+    "Destination ID: {destination_id}\n"
+    "Category: {category_name}\n"
+    "Tags: {tags}\n"
+    "Bill ID: {bill_id}\n"
+    "Missing Info: {missing_info}\n"
+    "Date: {date}\n"
+    "\nNow confirm or regenerate?"
+)
+
+CONFIRM_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ OK", callback_data="ok"),
+        InlineKeyboardButton("❌ Cancel", callback_data="cancel")
+    ],
+    [InlineKeyboardButton("➕ Add Context", callback_data="add_context")]
+])
+
+REGENERATE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("OK", callback_data="ok"),
+        InlineKeyboardButton("Regenerate", callback_data="regenerate"),
+        InlineKeyboardButton("Cancel", callback_data="cancel")
+    ],
+    [InlineKeyboardButton("Add Context", callback_data="add_context")]
+])
+
+INTENT_CACHE_SIZE = 512
+INTENT_CACHE_TTL = 600  # seconds
+_intent_cache = OrderedDict()  # (user_id, text, date) -> (timestamp, proposal)
+
+async def cached_intent(user_id: int, text: str, refresh: bool = False):
+    """
+    Run intent_filter.determine_intent in a worker thread, reusing a recent
+    result for the same user and text. refresh=True (Regenerate) always asks
+    again and stores the new answer. Returns a copy the caller may mutate.
+    """
+    key = (user_id, text, datetime.date.today())
+    now = time.monotonic()
+    if not refresh:
+        hit = _intent_cache.get(key)
+        if hit is not None and now - hit[0] < INTENT_CACHE_TTL:
+            _intent_cache.move_to_end(key)
+            return copy.deepcopy(hit[1])
+
+    proposal = await asyncio.to_thread(intent_filter.determine_intent, text)
+    if proposal:
+        _intent_cache[key] = (now, proposal)
+        _intent_cache.move_to_end(key)
+        while len(_intent_cache) > INTENT_CACHE_SIZE:
+            _intent_cache.popitem(last=False)
+        return copy.deepcopy(proposal)
+    return proposal
+
 # Simple account fetch for menu:
 def fetch_accounts():
     """Return a list of (account_id, account_name) from local DB for assets only."""
-    conn = sqlite3.connect("firefly_local.db")
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM accounts ORDER BY name ASC")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return get_ro_conn().execute("SELECT id, name FROM accounts ORDER BY name ASC").fetchall()
 
-def is_user_authorized(user_id: int) -> bool:
-    """Check if the user is in the authorized list."""
-    return user_id in AUTHORIZED_USERS
+def account_picker_keyboard():
+    """
+    Return the account picker markup (one button per account, then Cancel), or
+    None when there are no accounts. Rebuilt only when the synced data changes.
+    """
+    return _account_picker_keyboard(data_version())
 
+@lru_cache(maxsize=1)
+def _account_picker_keyboard(version):
+    accounts = fetch_accounts()
+    if not accounts:
+        return None
+    # Compact "p:<id>" callback data keeps the keyboard payload small
+    buttons = [[InlineKeyboardButton(f"{acc_name} (ID {acc_id})", callback_data=f"p:{acc_id}")]
+               for (acc_id, acc_name) in accounts]
+    buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
+    return InlineKeyboardMarkup(buttons)
+
+def require_auth(handler):
+    """Skip the handler entirely (no reply) unless the sender is an authorized user."""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if update.effective_user.id not in AUTHORIZED_USERS:
+            return  # Do not respond if the user is not authorized
+        return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+@require_auth
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
     await update.message.reply_text("👋 Hi! Tell me about a transaction, like 'Pay 768 yen at Sukiya'.")
 
+@require_auth
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """First entry point for user messages that aren't commands."""
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
-
     # Send a loading message
     loading_message = await update.message.reply_text("⏳ Processing your request...")
 
     user_text = update.message.text.strip()
-    proposal = intent_filter.determine_intent(user_text)
+    proposal = await cached_intent(update.effective_user.id, user_text)
 
     if not proposal:
         await loading_message.edit_text("❌ I couldn't parse your message. Try again.")
@@ -77,55 +202,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def present_proposal(update: Update, proposal: dict):
     """Show the user a summary of the final transaction and ask for confirmation."""
-    msg = (
-        "Proposed Transaction"
-        "📋 Type:{type}\n"
-        "💰 Amount: {amount} {currency_code}\n"
-        "📝 Description: {description}\n"
-        "🏦 Source: {source_name}(ID: {source_id})\n"
-        "📤 Destination: {destination_name} (ID: {destination_id})\n"
-        "📂 Category: {category_name}\n"
-        "🏷️ Tags: {tags} \n"
-        "🧾 Bill: {bill_name} (ID: {bill_id})\n"
-        "❓ Missing Info: {missing_info}\n"
-        "📅 Date: {date} \n"
-    ).format(
-        type=proposal['type'],
-        amount=proposal['amount'],
-        currency_code=proposal['currency_code'],
-        description=proposal['description'],
-        source_name=proposal['source_name'],
-        source_id=proposal['source_id'],
-        destination_name=proposal['destination_name'],
-        destination_id=proposal['destination_id'],
-        bill_name=proposal['bill_name'],
-        bill_id=proposal['bill_id'],
-        category_name=proposal['category_name'],
-        tags=', '.join(proposal['tags']) if proposal['tags'] else 'None',
-        missing_info=', '.join(proposal['missing_info']) if proposal['missing_info'] else 'None',
-        date=proposal['date']
-    )
-
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ OK", callback_data="ok"),
-            InlineKeyboardButton("❌ Cancel", callback_data="cancel")
-        ],
-        [InlineKeyboardButton("➕ Add Context", callback_data="add_context")]
-    ]
-    await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
-
+    msg = PROPOSAL_TMPL.format_map({
+        **proposal,
+        "tags": ', '.join(proposal['tags']) if proposal['tags'] else 'None',
+        "missing_info": ', '.join(proposal['missing_info']) if proposal['missing_info'] else 'None',
+    })
+    await update.message.reply_text(msg, reply_markup=CONFIRM_KB)
+
+@require_auth
 async def prompt_for_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE, proposal: dict):
     """
     If user is missing source/destination, offer an account picker.
     We'll do it in a simple step: pick source first, then destination if needed.
     """
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
-
-    accounts = fetch_accounts()
-    if not accounts:
-        await update.message.reply_text("No accounts found. Please add some accounts first.")
+    keyboard = account_picker_keyboard()
+    if keyboard is None:
+        await update.effective_message.reply_text("No accounts found. Please add some accounts first.")
         return
 
     # We'll store the user_data that we need to pick. 
@@ -152,33 +244,23 @@ async def prompt_for_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE
     field_to_pick = needed[0]
     context.user_data["field_to_pick"] = field_to_pick
 
-    # Build inline keyboard with each account as a button
-    buttons = []
-    for (acc_id, acc_name) in accounts:
-        buttons.append([InlineKeyboardButton(f"{acc_name} (ID {acc_id})",
-                      callback_data=f"pick_account_{acc_id}")])
-
-    buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
     await update.effective_message.reply_text(
         f"Please select {field_to_pick} from your available asset accounts:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=keyboard
     )
 
+@require_auth
 async def account_picker_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles user picking an account from the inline keyboard."""
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
-
     query = update.callback_query
     await query.answer()
 
-    data = query.data  # e.g. 'pick_account_12'
-    if not data.startswith("pick_account_"):
+    data = query.data  # e.g. 'p:12'
+    if not data.startswith("p:"):
         return
 
-    acc_id_str = data.replace("pick_account_", "")
     try:
-        acc_id = int(acc_id_str)
+        acc_id = int(data[2:])
     except ValueError:
         await query.edit_message_text("Invalid account ID selected.")
         return
@@ -205,7 +287,7 @@ async def account_picker_callback(update: Update, context: ContextTypes.DEFAULT_
         # Check if the other one is still missing
         if "destination_id" in proposal["missing_info"]:
             # Prompt for destination now
-            await prompt_for_accounts(query, context, proposal)
+            await prompt_for_accounts(update, context, proposal)
             return
 
     # If all done picking, show final proposal
@@ -215,32 +297,10 @@ async def account_picker_callback(update: Update, context: ContextTypes.DEFAULT_
 
 async def present_proposal_after_pick(query, proposal):
     """Re-send the final summary after picking an account from the inline keyboard."""
-    msg = (
-        f"🚀 Updated transaction:\n"
-        f"Type: {proposal['type']}\n"
-        f"Amount: {proposal['amount']} {proposal['currency_code']}\n"
-        f"Description: {proposal['description']}\n"
-        f"Source ID: {proposal['source_id']}\n"
-        f"Destination ID: {proposal['destination_id']}\n"
-        f"Category: {proposal['category_name']}\n"
-        f"Tags: {proposal['tags']}\n"
-        f"Bill ID: {proposal['bill_id']}\n"
-        f"Missing Info: {proposal['missing_info']}\n"
-        f"Date: {proposal['date']}\n"
-        "\nNow confirm or regenerate?"
-    )
-    keyboard = [
-        [
-            InlineKeyboardButton("OK", callback_data="ok"),
-            InlineKeyboardButton("Regenerate", callback_data="regenerate"),
-            InlineKeyboardButton("Cancel", callback_data="cancel")
-        ],
-        [InlineKeyboardButton("Add Context", callback_data="add_context")]
-    ]
-    await query.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.message.reply_text(PROPOSAL_AFTER_PICK_TMPL.format_map(proposal), reply_markup=REGENERATE_KB)
 
 async def post_transaction(proposal: dict):
-    """Post the transaction to Firefly's /transactions API using call_firefly_api_curl."""
+    """Post the transaction to Firefly's /transactions API using call_firefly_api."""
     endpoint = "/transactions"
 
     # Build base transaction payload
@@ -266,8 +326,8 @@ async def post_transaction(proposal: dict):
 
     payload = {"transactions": [transaction]}
 
-    logging.debug(f"POST Payload: {json.dumps(payload, indent=2)}")
-    response = call_firefly_api_curl(endpoint, method="POST", data=payload)
+    logging.debug(f"POST Payload: {orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode()}")
+    response = await call_firefly_api(endpoint, method="POST", data=payload)
     if response and "errors" not in response:
         logging.info(f"Transaction successfully posted to Firefly. Response: {response}")
         
@@ -295,11 +355,19 @@ async def post_transaction(proposal: dict):
         logging.error("Failed to post transaction. No valid response received.")
         return False
 
+# Users whose next text message is extra context for their current proposal
+_awaiting_context = set()
+
+class _AwaitingContextFilter(filters.MessageFilter):
+    """Matches messages from users who pressed Add Context."""
+    def filter(self, message):
+        return message.from_user is not None and message.from_user.id in _awaiting_context
+
+AWAITING_CONTEXT = _AwaitingContextFilter(name="AwaitingContext")
+
+@require_auth
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle OK, Regenerate, Add Context, Cancel from the main menu."""
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
-
     query = update.callback_query
     await query.answer()
     proposal = context.user_data.get("proposal")
@@ -321,10 +389,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text("❌ Failed to send transaction. Please try again.")
         context.user_data.clear()
+        _awaiting_context.discard(update.effective_user.id)
 
     elif action == "regenerate":
         original_input = context.user_data.get("original_input", "")
-        new_proposal = intent_filter.determine_intent(original_input)
+        new_proposal = await cached_intent(update.effective_user.id, original_input, refresh=True)
         if new_proposal:
             context.user_data["proposal"] = new_proposal
 
@@ -340,44 +409,80 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif action == "add_context":
         await query.edit_message_text("Please provide additional context (e.g. 'for dinner' or 'for electricity bill').")
-        context.user_data["awaiting_context"] = True
+        _awaiting_context.add(update.effective_user.id)
 
     elif action == "cancel":
         await query.edit_message_text("Operation cancelled.")
         context.user_data.clear()
+        _awaiting_context.discard(update.effective_user.id)
 
+@require_auth
 async def handle_additional_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """If the user wanted to add context, we re-run the LLM with the new input."""
-    if not is_user_authorized(update.effective_user.id):
-        return  # Do not respond if the user is not authorized
-
-    if not context.user_data.get("awaiting_context"):
-        return await handle_message(update, context)
-
+    """The user pressed Add Context: re-run the LLM with the original input plus this text."""
     additional = update.message.text.strip()
     original_input = context.user_data.get("original_input", "")
     new_input = f"{original_input}, {additional}"
 
-    new_proposal = intent_filter.determine_intent(new_input)
+    new_proposal = await cached_intent(update.effective_user.id, new_input)
     if not new_proposal:
         await update.message.reply_text("❌ Could not parse with the added context.")
         return
 
     context.user_data["proposal"] = new_proposal
     context.user_data["original_input"] = new_input
-    context.user_data.pop("awaiting_context", None)
+    _awaiting_context.discard(update.effective_user.id)
 
     if "source_id" in new_proposal["missing_info"] or "destination_id" in new_proposal["missing_info"]:
         await prompt_for_accounts(update, context, new_proposal)
     else:
         await present_proposal(update, new_proposal)
 
+# Fixed callback_data values handled by button_callback; "p:<id>" goes to the account picker.
+CALLBACK_ROUTES = {
+    "ok": button_callback,
+    "regenerate": button_callback,
+    "add_context": button_callback,
+    "cancel": button_callback,
+}
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Single entry point for inline keyboard presses, dispatched on callback_data."""
+    data = update.callback_query.data
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None and data.startswith("p:"):
+        handler = account_picker_callback
+    if handler is not None:
+        await handler(update, context)
+
+async def on_startup(app: Application):
+    """Open the Firefly connection in the background so the first request reuses it."""
+    app.create_task(call_firefly_api("/about"))
+
+async def on_shutdown(app: Application):
+    """Close the pooled Firefly HTTP client."""
+    await _http.aclose()
+
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    try:
+        import uvloop  # faster event loop for the polling and HTTP callbacks
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    # Load the model, index and HTTP connections while the bot starts polling
+    warmup.start()
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_additional_context))
-    app.add_handler(CallbackQueryHandler(button_callback, pattern="^(ok|regenerate|add_context|cancel)$"))
-    app.add_handler(CallbackQueryHandler(account_picker_callback, pattern="^pick_account_"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & AWAITING_CONTEXT, handle_additional_context))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(CallbackQueryHandler(route_callback))
 
     print("🚀 Bot is running. Talk to it on Telegram!")
     app.run_polling()
@@ -1,10 +1,10 @@
 import logging
 from dotenv import load_dotenv
 import os
-import sqlite3
 
 from intent_filter import find_similar_transactions, DB_PATH as INTENT_DB_PATH
 from firefly_sync import DB_PATH as SYNC_DB_PATH
+from db import get_ro_conn
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,11 +26,22 @@ TEST_CASES = [
     {"input": "Paid Pak Surya", "expected_id": "161", "description": "Should suggest Yucho as source for 'Bayar Hutang ke Pak Surya' (ID 161)"},
 ]
 
+# Details of a matched transaction; kept as one constant so the connection's
+# statement cache reuses the prepared query on every test case.
+MATCH_SQL = """
+    SELECT t.description, t.source_name, t.destination_name, t.category_name, t.type,
+           GROUP_CONCAT(tt.name, ', ') AS tags, t.amount
+    FROM transactions t
+    LEFT JOIN transactions_tags tt ON t.id = tt.transaction_id
+    WHERE t.id = ?
+    GROUP BY t.id
+"""
+
 def run_tests():
     logger.info("Starting similarity tests using existing database: %s", DB_PATH)
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    # One shared read-only connection for the whole run
+    cur = get_ro_conn().cursor()
     for tid in ["146", "148", "161"]:
         cur.execute("SELECT description, category_id, source_name, destination_name FROM transactions WHERE id = ?", (tid,))
         result = cur.fetchone()
@@ -38,7 +49,6 @@ def run_tests():
             logger.info("Transaction ID %s found: description=%s, category_id=%s, source=%s, destination=%s", tid, *result)
         else:
             logger.warning("Transaction ID %s not found in database!", tid)
-    conn.close()
 
     for test in TEST_CASES:
         logger.info("Testing input: %s", test["input"])
@@ -51,22 +61,12 @@ def run_tests():
             tid, similarity = top_match
             logger.info("Top match: transaction_id=%s, similarity=%.4f", tid, similarity)
             
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT t.description, t.source_name, t.destination_name, t.category_name, t.type,
-                       GROUP_CONCAT(tt.name, ', ') AS tags, t.amount
-                FROM transactions t
-                LEFT JOIN transactions_tags tt ON t.id = tt.transaction_id
-                WHERE t.id = ?
-                GROUP BY t.id
-            """, (tid,))
+            cur.execute(MATCH_SQL, (tid,))
             matched_tx = cur.fetchone()
             if matched_tx:
                 desc, src, dest, cat, typ, tags, amount = matched_tx
                 logger.info("Matched details: description=%s, source=%s, destination=%s, category=%s, type=%s, tags=%s, amount=%s",
                             desc, src, dest, cat, typ, tags, amount)
-            conn.close()
 
             if tid == test["expected_id"]:
                 logger.info("[PASS] Test passed: Correct transaction found.")
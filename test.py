@@ -1,140 +1,295 @@
 import os
+import argparse
+import orjson
 import asyncio
-from dotenv import load_dotenv
+from dotenv import dotenv_values
+import ssl
+import logging
+import socket
+from operator import itemgetter
 import telegram
-import requests
+import httpx
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
+logger = logging.getLogger("fftest")
+
+def _write_private(path, data):
+    """
+    Atomically write data to path readable by the owner only (it holds the same
+    secrets as .env). A failed write leaves no temp file and no cache behind.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)  # O_CREAT keeps an existing file's mode
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write %s: %s", path, e)
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+def load_env_cached(path=".env", cache=".env.cache.json"):
+    """
+    Load path into os.environ (existing variables win, as with load_dotenv) and
+    return the resulting environment. The parsed file is kept in a JSON sidecar
+    and reused while it is newer than path, so warm starts skip the .env parse.
+    """
+    try:
+        env_mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return dict(os.environ)
+
+    try:
+        if os.stat(cache).st_mtime < env_mtime:
+            raise FileNotFoundError(cache)
+        with open(cache, "rb") as f:
+            values = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        values = {k: v for k, v in dotenv_values(path).items() if v is not None}
+        _write_private(cache, orjson.dumps(values))
+
+    for key, value in values.items():
+        os.environ.setdefault(key, value)
+    return dict(os.environ)
+
 # Load environment variables from .env file
-load_dotenv()
+cfg = load_env_cached()
+
+TELEGRAM_BOT_TOKEN = cfg.get("TELEGRAM_BOT_TOKEN")
+FIREFLY_API_TOKEN = cfg.get("FIREFLY_API_TOKEN")
+FIREFLY_API_URL = cfg.get("FIREFLY_API_URL")
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-FIREFLY_API_TOKEN = os.getenv("FIREFLY_API_TOKEN")
-FIREFLY_API_URL = os.getenv("FIREFLY_API_URL")
+# Firefly requests share one client per test run, so retries reuse the TCP/TLS connection
+FIREFLY_HEADERS = {
+    "accept": "application/json",  # Lowercase to match curl
+    "Authorization": f"Bearer {FIREFLY_API_TOKEN}",
+    "User-Agent": "curl/7.68.0",  # Mimic curl; some reverse proxies reject other clients
+}
+FIREFLY_ABOUT_URL = f"{FIREFLY_API_URL}/about"
+about_data = itemgetter("data")  # /about payload -> {"version": ..., ...}
+FIREFLY_LIMITS = httpx.Limits(max_connections=4, max_keepalive_connections=4)
+# No Nagle delay on the small probe requests; keep-alive for the pooled connection
+SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
 
-# Global variable to store chat_id
-CHAT_ID = None
+# Ready-made client for the SSL fallback, so it doesn't build a transport and pool on failure
+FIREFLY_NOVERIFY_CLIENT = httpx.AsyncClient(
+    headers=FIREFLY_HEADERS,
+    transport=httpx.AsyncHTTPTransport(verify=False, limits=FIREFLY_LIMITS, socket_options=SOCKET_OPTIONS),
+    timeout=10,
+)
+
+def _is_ssl_error(exc):
+    """True if an httpx error was caused by a TLS failure."""
+    while exc is not None:
+        if isinstance(exc, ssl.SSLError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+async def _report_chat_id(update, context):
+    """Resolve the test's chat ID future with this chat and confirm in Telegram."""
+    chat_id = update.message.chat_id
+    context.application.bot_data["chat_id_fut"].set_result(chat_id)
+    # Nothing left to capture: stop routing further updates to these handlers
+    for handler in context.application.bot_data["chat_id_handlers"]:
+        context.application.remove_handler(handler)
+    await update.message.reply_text(f"Chat ID detected: {chat_id}. Connection test successful!")
+    logger.info("Telegram Bot Connected: @%s", context.bot.username)
+    logger.info("Chat ID retrieved: %s", chat_id)
+    logger.info("Test message sent to Telegram successfully.")
 
 # Handle /start command to get chat_id
 async def start(update, context):
-    global CHAT_ID
-    CHAT_ID = update.message.chat_id
-    await update.message.reply_text(f"Chat ID detected: {CHAT_ID}. Connection test successful!")
-    print(f"Telegram Bot Connected: @{context.bot.username}")
-    print(f"Chat ID retrieved: {CHAT_ID}")
-    print("Test message sent to Telegram successfully.")
+    if not context.application.bot_data["chat_id_fut"].done():
+        await _report_chat_id(update, context)
 
 # Handle any message to ensure chat_id is captured
 async def handle_message(update, context):
-    global CHAT_ID
-    if CHAT_ID is None:
-        CHAT_ID = update.message.chat_id
-        await update.message.reply_text(f"Chat ID detected: {CHAT_ID}. Connection test successful!")
-        print(f"Telegram Bot Connected: @{context.bot.username}")
-        print(f"Chat ID retrieved: {CHAT_ID}")
-        print("Test message sent to Telegram successfully.")
+    if not context.application.bot_data["chat_id_fut"].done():
+        await _report_chat_id(update, context)
 
 # Test Telegram Bot Connection with automated chat_id retrieval
 async def test_telegram_connection():
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN is not set; skipping the Telegram test.")
+        return False
     try:
         # Set up the bot application
         application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
 
-        # Add handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        # Add handlers (removed again once the chat ID is captured)
+        chat_id_handlers = [
+            CommandHandler("start", start),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message),
+        ]
+        application.add_handlers(chat_id_handlers)
+        application.bot_data["chat_id_handlers"] = chat_id_handlers
+
+        # Resolved by the first handler that sees a chat; awaited below
+        chat_id_fut = asyncio.get_running_loop().create_future()
+        application.bot_data["chat_id_fut"] = chat_id_fut
 
-        print("Telegram Bot is running... Please send a message to the bot (e.g., /start).")
+        logger.info("Telegram Bot is running... Please send a message to the bot (e.g., /start).")
         
         # Start polling for updates
         await application.initialize()
         await application.start()
-        await application.updater.start_polling()
+        await application.updater.start_polling(poll_interval=1.0, timeout=10)
 
-        # Wait for a few seconds to allow user interaction
-        await asyncio.sleep(10)  # Adjust this duration as needed
+        # Wait up to 10 seconds for the user, returning as soon as a chat ID arrives
+        try:
+            await asyncio.wait_for(chat_id_fut, timeout=10.0)
+        except asyncio.TimeoutError:
+            pass  # wait_for cancels the future, so late messages are ignored
 
         # Stop polling after chat_id is retrieved or timeout
         await application.updater.stop()
         await application.stop()
 
-        if CHAT_ID is None:
-            print("No chat ID retrieved. Please message the bot within 10 seconds.")
-        else:
-            print("Telegram connection test completed.")
+        if chat_id_fut.cancelled():
+            logger.warning("No chat ID retrieved. Please message the bot within 10 seconds.")
+            return False
+        logger.info("Telegram connection test completed.")
+        return True
 
     except Exception as e:
-        print(f"Telegram Connection Failed: {str(e)}")
+        logger.error("Telegram Connection Failed: %s", e)
+        return False
+
+ERROR_BODY_CAP = 512  # bytes of a failed response to download and show
+
+async def _get(client, url, **kwargs):
+    """
+    Stream a GET and return (response, body). The body is read in full for a
+    200 and capped at ERROR_BODY_CAP bytes otherwise, so a large HTML error
+    page is never downloaded just to print its start.
+    """
+    async with client.stream("GET", url, **kwargs) as response:
+        if response.status_code == 200:
+            return response, await response.aread()
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) >= ERROR_BODY_CAP:
+                break
+        return response, bytes(body[:ERROR_BODY_CAP])
+
+def _preview(body):
+    return body[:ERROR_BODY_CAP].decode("utf-8", "replace")
 
 # Test Firefly III API Connection
-def test_firefly_connection():
+async def test_firefly_connection():
+    if not (FIREFLY_API_URL and FIREFLY_API_TOKEN):
+        logger.warning("FIREFLY_API_URL or FIREFLY_API_TOKEN is not set; skipping the Firefly III test.")
+        return False
+    url = FIREFLY_ABOUT_URL
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=2, limits=FIREFLY_LIMITS,
+                                         socket_options=SOCKET_OPTIONS)
     try:
-        # Headers matching curl exactly
-        headers = {
-            "accept": "application/json",  # Lowercase to match curl
-            "Authorization": f"Bearer {FIREFLY_API_TOKEN}"
-        }
-        
-        url = f"{FIREFLY_API_URL}/about"
-        print(f"Requesting URL: {url}")
-        print(f"Token (partial): {FIREFLY_API_TOKEN[:10]}...")
-        print(f"Headers: {headers}")
-        
-        # Make request without following redirects
-        response = requests.get(url, headers=headers, timeout=10, allow_redirects=False)
-        
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Headers: {dict(response.headers)}")
-        if response.status_code == 200:
-            data = response.json()
-            print("Firefly III API Connected Successfully!")
-            print(f"Firefly III Version: {data['data']['version']}")
-        else:
-            print(f"Firefly III Connection Failed: {response.status_code}")
-            print(f"Response: {response.text[:500]}...")
-            
-        # Test with curl-like User-Agent if it fails
-        if response.status_code != 200:
-            print("\nRetrying with curl User-Agent...")
-            headers["User-Agent"] = "curl/7.68.0"  # Mimic curl
-            response = requests.get(url, headers=headers, timeout=10, allow_redirects=False)
-            
-            print(f"Status Code: {response.status_code}")
-            print(f"Response Headers: {dict(response.headers)}")
+        async with httpx.AsyncClient(headers=FIREFLY_HEADERS, transport=transport, timeout=10) as client:
+            logger.info("Requesting URL: %s", url)
+            logger.info("Token (partial): %s...", FIREFLY_API_TOKEN[:10])
+            logger.debug("Headers: %s", client.headers)
+
+            # Probe with a body-less HEAD first (without following redirects); only
+            # GET when it succeeds (to read the version) or HEAD isn't supported
+            response = await client.head(url, timeout=5, follow_redirects=False)
+            body = None
+            if response.status_code in (200, 204, 405, 501):
+                response, body = await _get(client, url, follow_redirects=False)
+
+            logger.info("Status Code: %s", response.status_code)
+            logger.debug("Response Headers: %s", response.headers)
             if response.status_code == 200:
-                data = response.json()
-                print("Firefly III API Connected Successfully with curl User-Agent!")
-                print(f"Firefly III Version: {data['data']['version']}")
+                about = about_data(orjson.loads(body))
+                logger.info("Firefly III API Connected Successfully!")
+                logger.info("Firefly III Version: %s", about["version"])
             else:
-                print(f"Firefly III Connection Failed with curl User-Agent: {response.status_code}")
-                print(f"Response: {response.text[:500]}...")
-
-    except requests.exceptions.SSLError as e:
-        print(f"SSL Error: {str(e)}")
-        print("Retrying with SSL verification disabled...")
-        response = requests.get(url, headers=headers, timeout=10, verify=False)
-        print(f"Status Code: {response.status_code}")
-        print(f"Response: {response.text[:500]}...")
+                logger.error("Firefly III Connection Failed: %s", response.status_code)
+                if body is not None:
+                    logger.info("Response: %s...", _preview(body))
+
+            return response.status_code == 200
+
+    except httpx.HTTPError as e:
+        if not _is_ssl_error(e):
+            logger.error("Firefly III Connection Failed: %s", e)
+            return False
+        logger.error("SSL Error: %s", e)
+        logger.info("Retrying with SSL verification disabled...")
+        try:
+            response, body = await _get(FIREFLY_NOVERIFY_CLIENT, url)
+            logger.info("Status Code: %s", response.status_code)
+            logger.info("Response: %s...", _preview(body))
+            return response.status_code == 200
+        except Exception as e:
+            logger.error("Firefly III Connection Failed: %s", e)
+            return False
     except Exception as e:
-        print(f"Firefly III Connection Failed: {str(e)}")
+        logger.error("Firefly III Connection Failed: %s", e)
+        return False
 
 # Run both tests
 async def run_tests(choice):
+    try:
+        await _run_tests(choice)
+    finally:
+        await FIREFLY_NOVERIFY_CLIENT.aclose()
+
+async def _run_tests(choice):
     if choice == "1":
-        print("1. Testing Telegram Bot Connection:")
+        logger.info("1. Testing Telegram Bot Connection:")
         await test_telegram_connection()
     elif choice == "2":
-        print("\n2. Testing Firefly III API Connection:")
-        test_firefly_connection()
+        logger.info("\n2. Testing Firefly III API Connection:")
+        await test_firefly_connection()
     else:
-        print("1. Testing Telegram Bot Connection:")
-        await test_telegram_connection()
-        print("\n2. Testing Firefly III API Connection:")
-        test_firefly_connection()
+        # Independent checks: let the Firefly round-trip overlap the Telegram polling window
+        logger.info("Testing Telegram Bot and Firefly III API connections concurrently:")
+        results = asyncio.Queue()
+
+        async def probe(name, check):
+            await results.put((name, await check()))
+
+        async def report(count):
+            # Print each verdict as soon as its probe finishes
+            for _ in range(count):
+                name, ok = await results.get()
+                logger.info("[%s] %s", name, 'OK' if ok else 'FAILED')
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(probe("Telegram", test_telegram_connection))
+            tg.create_task(probe("Firefly III", test_firefly_connection))
+            tg.create_task(report(2))
+
+# --mode values mapped onto the interactive menu choices
+MODES = {"telegram": "1", "firefly": "2", "both": "both"}
 
 def main():
-    print("Testing connections...\n")
-    choice = input("Choose test to run (1=Telegram, 2=Firefly, anything else=both): ")
+    parser = argparse.ArgumentParser(description="Check the Telegram bot token and Firefly III API access.")
+    parser.add_argument("--mode", choices=MODES, help="run without the interactive prompt")
+    args = parser.parse_args()
+
+    try:
+        import uvloop  # faster event loop for PTB polling and the httpx probe
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logger.info("Testing connections...")
+    if args.mode:
+        choice = MODES[args.mode]
+    else:
+        choice = input("Choose test to run (1=Telegram, 2=Firefly, anything else=both): ")
     asyncio.run(run_tests(choice))
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+# warmup.py
+
+import logging
+import threading
+
+import intent_filter
+from context_loader import build_prompt_context
+from embeddings import get_model
+
+def _warm_up():
+    """
+    Pay the one-off startup costs before the first user message arrives:
+    torch + model weights and the embedding index, the prompt context and the
+    OpenAI client's connection. The bot opens its Firefly connection itself.
+    """
+    steps = [
+        # Encode directly: the similarity search skips the model when the index is empty
+        ("embedding model", lambda: get_model().encode("warmup")),
+        ("embedding index", lambda: intent_filter.find_similar_transactions("warmup", top_k=1)),
+        ("prompt context", build_prompt_context),
+        ("OpenAI connection", intent_filter.client.models.list),
+    ]
+    for name, step in steps:
+        try:
+            step()
+            logging.info(f"Warmed up {name}")
+        except Exception as e:
+            logging.warning(f"Warmup of {name} failed: {e}")
+
+def start():
+    """Run the warmup in a background daemon thread and return immediately."""
+    threading.Thread(target=_warm_up, name="warmup", daemon=True).start()